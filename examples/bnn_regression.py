@@ -1,6 +1,7 @@
 import argparse
 import gc
 import numpy as np
+import os
 import torch
 
 from matplotlib import pyplot as plt
@@ -42,7 +43,9 @@ def main():
     # model parameters
     parser = argparse.ArgumentParser("BNN regression example")
     parser.add_argument('--seed', type=int, default=0)
-    parser.add_argument('--num_threads', type=int, default=1)
+    parser.add_argument('--num_threads',
+                        type=int,
+                        default=min(os.cpu_count() or 1, 8))
     parser.add_argument('--net_shape',
                         type=lambda s: [int(d) for d in s.split(',')],
                         default=[200, 200])
@@ -85,12 +88,6 @@ def main():
                               output_density=models.GaussianMixtureDensity(
                                   odims, args.n_components))
 
-    # optimizer for single gaussian model
-    opt1 = torch.optim.Adam(model.parameters(), args.lr)
-
-    # optimizer for mixture density network
-    opt2 = torch.optim.Adam(mmodel.parameters(), args.lr)
-
     # create training dataset
     train_x = np.concatenate([
         np.linspace(-1.6, -0.25, 100),
@@ -108,12 +105,25 @@ def main():
     model = model.float()
     mmodel = mmodel.float()
 
-    if args.use_cuda and torch.cuda.is_available():
+    use_cuda = args.use_cuda and torch.cuda.is_available()
+    if use_cuda:
         X = X.cuda()
         Y = Y.cuda()
         model = model.cuda()
         mmodel = mmodel.cuda()
 
+    # optimizer for single gaussian model
+    opt1 = torch.optim.Adam(model.parameters(),
+                            args.lr,
+                            fused=use_cuda,
+                            foreach=not use_cuda)
+
+    # optimizer for mixture density network
+    opt2 = torch.optim.Adam(mmodel.parameters(),
+                            args.lr,
+                            fused=use_cuda,
+                            foreach=not use_cuda)
+
     print(('Dataset size:', train_x.shape[0], 'samples'))
     # train unimodal regressor
     utils.train_regressor(model,
@@ -128,8 +138,9 @@ def main():
     ret = []
     if args.resample:
         model.resample()
+    dev, dt = model.X.device, model.X.dtype
     for i, x in enumerate(test_x):
-        x = torch.tensor(x[None]).float().to(model.X.device)
+        x = torch.as_tensor(x[None], dtype=dt, device=dev)
         outs = model(x.expand((2 * args.N_batch, 1)), resample=False)
         y = torch.cat(outs[:2], -1)
         ret.append(y.cpu().detach().numpy())
@@ -169,8 +180,9 @@ def main():
     logit_weights = []
     if args.resample:
         mmodel.resample()
+    dev, dt = mmodel.X.device, mmodel.X.dtype
     for i, x in enumerate(test_x):
-        x = torch.tensor(x[None]).float().to(mmodel.X.device)
+        x = torch.as_tensor(x[None], dtype=dt, device=dev)
         outs = mmodel(x.expand((2 * args.N_batch, 1)), resample=False)
         y = torch.cat(outs[:2], -2)
         ret.append(y.cpu().detach().numpy())
@@ -129,13 +129,17 @@ if __name__ == '__main__':
                         type=str,
                         default="~/.prob_mbrl/")
     parser.add_argument('-s', '--seed', type=int, default=1)
-    parser.add_argument('--num_threads', type=int, default=1)
+    parser.add_argument('--num_threads',
+                        type=int,
+                        default=min(os.cpu_count() or 1, 8))
     parser.add_argument('--n_initial_epi', type=int, default=0)
     parser.add_argument('--load_from', type=str, default=None)
     parser.add_argument('--pred_H', type=int, default=15)
     parser.add_argument('--control_H', type=int, default=40)
     parser.add_argument('--discount_factor', type=str, default=None)
     parser.add_argument('--prioritized_replay', action='store_true')
+    parser.add_argument('--prioritized_episodes', action='store_true')
+    parser.add_argument('--pol_opt_patience', type=int, default=None)
     parser.add_argument('--timesteps_to_sample',
                         type=utils.load_csv,
                         default=0)
@@ -165,6 +169,9 @@ if __name__ == '__main__':
     parser.add_argument('--plot_level', type=int, default=0)
     parser.add_argument('--render', action='store_true')
     parser.add_argument('--use_cuda', action='store_true')
+    parser.add_argument('--compile', action='store_true')
+    parser.add_argument('--mixed_precision', action='store_true')
+    parser.add_argument('--compile_mm', action='store_true')
     parser.add_argument('--learn_reward', action='store_true')
     parser.add_argument('--keep_best', action='store_true')
     parser.add_argument('--stop_when_done', action='store_true')
@@ -289,18 +296,38 @@ if __name__ == '__main__':
     if loaded_from is not None:
         utils.load_checkpoint(loaded_from, dyn, pol, exp, V)
 
+    # move models to the gpu before creating their optimizers
+    use_cuda = args.use_cuda and torch.cuda.is_available()
+    if use_cuda:
+        dyn = dyn.cuda()
+        pol = pol.cuda()
+        V = V.cuda()
+        V_target = V_target.cuda()
+
+    # compile the policy and dynamics networks. this is done in place, so
+    # the parameter names (and saved checkpoints) stay the same. noise
+    # resampling happens outside of forward, in uncompiled code
+    if args.compile:
+        dyn.model.compile()
+        pol.model.compile()
+
     # initialize dynamics optimizer
-    opt1 = torch.optim.Adam(dyn.parameters(), args.dyn_lr)
+    opt1 = torch.optim.Adam(dyn.parameters(),
+                            args.dyn_lr,
+                            fused=use_cuda,
+                            foreach=not use_cuda)
 
     # initialize policy optimizer
-    opt2 = torch.optim.Adam(pol.parameters(), args.pol_lr)
+    opt2 = torch.optim.Adam(pol.parameters(),
+                            args.pol_lr,
+                            fused=use_cuda,
+                            foreach=not use_cuda)
 
     # initialize critic optimizer
-    opt3 = torch.optim.Adam(V.parameters(), args.val_lr)
-
-    if args.use_cuda and torch.cuda.is_available():
-        dyn = dyn.cuda()
-        pol = pol.cuda()
+    opt3 = torch.optim.Adam(V.parameters(),
+                            args.val_lr,
+                            fused=use_cuda,
+                            foreach=not use_cuda)
 
     writer = tensorboardX.SummaryWriter(
         logdir=os.path.join(results_folder, "logs"))
@@ -331,6 +358,7 @@ if __name__ == '__main__':
     render_fn = (lambda *args, **kwargs: env.render()) if args.render else None
     update_V_fn = partial(update_value_function, V, opt3, args.pred_H)
     for ps_it in range(args.ps_iters):
+        dev, dt = dyn.X.device, dyn.X.dtype
         # apply policy
         new_exp = exp.n_samples() + args.control_H
         while exp.n_samples() < new_exp:
@@ -347,8 +375,8 @@ if __name__ == '__main__':
         # train dynamics
         X, Y = exp.get_dynmodel_dataset(deltas=True,
                                         return_costs=args.learn_reward)
-        dyn.set_dataset(X.to(dyn.X.device, dyn.X.dtype),
-                        Y.to(dyn.X.device, dyn.X.dtype))
+        dyn.set_dataset(utils.to_device(X, dev, dt),
+                        utils.to_device(Y, dev, dt))
         utils.train_regressor(dyn,
                               args.dyn_opt_iters,
                               args.dyn_batch_size,
@@ -359,21 +387,45 @@ if __name__ == '__main__':
                               summary_writer=writer,
                               summary_scope='model_learning/episode_%d' %
                               ps_it)
+        if args.prioritized_episodes:
+            # sample initial states more often from the episodes where the
+            # dynamics model is least accurate
+            exp.set_priorities(
+                utils.episode_errors(dyn,
+                                     exp,
+                                     deltas=True,
+                                     return_costs=args.learn_reward))
         torch.save(dyn.state_dict(),
                    os.path.join(results_folder, 'latest_dynamics.pth.tar'))
 
         # sample initial states for policy optimization
         x0 = exp.sample_states(args.pol_batch_size,
-                               timestep=0).to(dyn.X.device,
-                                              dyn.X.dtype).detach()
+                               timestep=0,
+                               prioritized=args.prioritized_episodes)
+        x0 = utils.to_device(x0, dev, dt).detach()
 
         if args.plot_level > 0:
             utils.plot_rollout(x0[:25], dyn, pol, args.pred_H * 2)
 
-        # train policy
+        # train policy. the losses stay on the device and are written to
+        # tensorboard in batches, instead of syncing on every iteration
+        losses = []
+
+        def flush_losses():
+            if len(losses) > 0:
+                its, values = zip(*losses)
+                values = torch.stack(values).cpu().tolist()
+                [
+                    writer.add_scalar(
+                        'mc_pilco/episode_%d/training loss' % ps_it, v, j)
+                    for j, v in zip(its, values)
+                ]
+                del losses[:]
+
         def on_iteration(i, loss, states, actions, rewards, discount):
-            writer.add_scalar('mc_pilco/episode_%d/training loss' % ps_it,
-                              loss, i)
+            losses.append((i, loss.detach()))
+            if len(losses) == 50:
+                flush_losses()
 
         print("Policy search iteration %d" % (ps_it + 1))
         algorithms.mc_pilco(x0,
@@ -394,9 +446,14 @@ if __name__ == '__main__':
                             step_idx_to_sample=args.timesteps_to_sample,
                             init_state_noise=1e-1 * x0.std(0),
                             prioritized_replay=args.prioritized_replay,
+                            mixed_precision=args.mixed_precision,
+                            compile_mm=args.compile_mm,
+                            prioritized_episodes=args.prioritized_episodes,
+                            patience=args.pol_opt_patience,
                             on_iteration=on_iteration,
                             on_rollout=update_V_fn,
                             debug=args.debug)
+        flush_losses()
         torch.save(pol.state_dict(),
                    os.path.join(results_folder, 'latest_policy.pth.tar'))
         torch.save(V.state_dict(),
@@ -73,8 +73,12 @@ if __name__ == "__main__":
         trajs = []
         # this loop could be parallelized????
         for j in range(n_evals):
+            # every evaluation runs a new sample of the policy, frozen so
+            # that each step is a single call into the traced graph
+            pol.resample()
+            frozen_pol = pol.freeze()
             ret = utils.apply_controller(env,
-                                         pol,
+                                         frozen_pol,
                                          args.control_H,
                                          stop_when_done=args.stop_when_done,
                                          callback=render_fn)
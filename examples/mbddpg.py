@@ -7,7 +7,7 @@ import tensorboardX
 
 from prob_mbrl import utils, algorithms, envs
 torch.set_flush_denormal(True)
-torch.set_num_threads(1)
+torch.set_num_threads(min(os.cpu_count() or 1, 8))
 
 if __name__ == '__main__':
     # parameters
@@ -96,8 +96,9 @@ if __name__ == '__main__':
         agent.fit(exp, H, 120, batch_size=N_particles)
 
         # plot rollout
-        x0 = torch.tensor(exp.sample_states(N_particles, timestep=0)).to(
-            agent.dyn.X.device).float()
+        x0 = torch.as_tensor(exp.sample_states(N_particles, timestep=0),
+                             dtype=agent.dyn.X.dtype,
+                             device=agent.dyn.X.device)
         x0 = x0 + 1e-1 * x0.std(0) * torch.randn_like(x0)
         x0 = x0.detach()
         utils.plot_rollout(x0, agent.dyn, agent.actor_target, H)
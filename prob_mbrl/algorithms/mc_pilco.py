@@ -37,6 +37,11 @@ def mc_pilco(init_states,
              priority_eps=1e-8,
              init_priority_beta=1.0,
              priority_beta_increase=0.0,
+             n_parallel_rollouts=1,
+             mixed_precision=False,
+             compile_mm=False,
+             prioritized_episodes=False,
+             patience=None,
              debug=False,
              rollout_kwargs={}):
     global policy_update_counter, x0_tree, episode_counter
@@ -53,13 +58,20 @@ def mc_pilco(init_states,
     if opt is None:
         params = filter(lambda p: p.requires_grad, policy.parameters())
         opt = torch.optim.Adam(params)
+    # each iteration averages the returns of K independent rollouts, batched
+    # as a single rollout of K times the number of particles; we take K times
+    # fewer (but less noisy) gradient steps
+    K = n_parallel_rollouts
+    opt_iters = max(1, int(opt_iters / K))
     pbar = tqdm.tqdm(range(opt_iters), total=opt_iters)
+    device, dtype = dynamics.X.device, dynamics.X.dtype
+    use_cuda = device.type == 'cuda'
     D = init_states.shape[-1]
-    shape = init_states.shape
-    z_mm = torch.randn(steps + shape[0], *shape[1:])
-    z_mm = z_mm.reshape(-1, D).to(dynamics.X.device, dynamics.X.dtype)
-    z_rr = torch.randn(steps + shape[0], 1)
-    z_rr = z_rr.reshape(-1, 1).to(dynamics.X.device, dynamics.X.dtype)
+    shape = (K * init_states.shape[0], ) + init_states.shape[1:]
+    # a single buffer holds the state and reward noise, so drawing new
+    # pegasus samples is one kernel launch
+    z_all = torch.randn(steps + shape[0], D + 1, device=device, dtype=dtype)
+    z_mm, z_rr = z_all[:, :D], z_all[:, D:]
 
     def resample():
         seed = torch.randint(2**32, [1])
@@ -67,8 +79,7 @@ def mc_pilco(init_states,
         policy.resample(seed=seed)
         if value_func is not None:
             value_func.resample(seed=seed)
-        z_mm.normal_()
-        z_rr.normal_()
+        z_all.normal_()
 
     # sample initial random numbers
     resample()
@@ -76,12 +87,44 @@ def mc_pilco(init_states,
     x0 = init_states
     N_particles = init_states.shape[0]
     n_opt_steps = policy_update_counter[policy]
+    # moment matching is done independently for each parallel rollout
+    if mm_groups is not None:
+        rollout_mm_groups = K * mm_groups
+    else:
+        rollout_mm_groups = K if K > 1 else None
 
     if prioritized_replay:
         x0_idxs = None
         x0_weights = torch.ones_like(x0)
         priority_beta = init_priority_beta
         # old_counts = x0_tree.counts.copy()
+        # the priority hooks need the per-step action tensors
+        trajectory_buffers = None
+    else:
+        # rollouts are written into buffers that are reused every iteration
+        trajectory_buffers = []
+        if exp is not None:
+            # prefetch the initial states for all iterations, so they are
+            # sampled and copied to the device only once
+            n_x0 = mm_groups if mm_groups is not None else N_particles
+            x0_pool = exp.sample_states(opt_iters * n_x0,
+                                        timestep=step_idx_to_sample,
+                                        pin_memory=use_cuda,
+                                        prioritized=prioritized_episodes)
+            x0_pool = utils.to_device(x0_pool, device,
+                                      dtype).view(opt_iters, n_x0, -1)
+
+    # run the network evaluations in the rollout with bf16 matmuls. moment
+    # matching and the loss are still computed in full precision
+    mixed_precision = mixed_precision and use_cuda
+
+    # discount weights for every step of the rollout (and the final value)
+    discount_weights = torch.tensor([discount(t) for t in range(steps + 1)],
+                                    device=device,
+                                    dtype=dtype)[:, None, None]
+
+    # stop early if the smoothed loss hasn't improved in patience iterations
+    running_loss, best_loss, since_best = None, float('inf'), 0
 
     for i in pbar:
         # zero gradients
@@ -97,25 +140,34 @@ def mc_pilco(init_states,
             x0_ = x0
             if mm_groups is not None and x0_.shape[0] == mm_groups:
                 x0_ = utils.tile(x0_, int(N_particles / mm_groups))
+            if K > 1:
+                x0_ = x0_.repeat(K, 1)
             x0_ = x0_ + init_state_noise * torch.randn_like(x0_)
-            trajectories = utils.rollout(x0_,
-                                         dynamics,
-                                         policy,
-                                         H,
-                                         resample_state_noise=not pegasus,
-                                         resample_action_noise=not pegasus,
-                                         mm_states=mm_states,
-                                         mm_rewards=mm_rewards,
-                                         z_mm=z_mm if pegasus else None,
-                                         z_rr=z_rr if pegasus else None,
-                                         mm_groups=mm_groups,
-                                         **rollout_kwargs)
+            with utils.autocast('cuda', torch.bfloat16, mixed_precision):
+                trajectories = utils.rollout(
+                    x0_,
+                    dynamics,
+                    policy,
+                    H,
+                    resample_state_noise=not pegasus,
+                    resample_action_noise=not pegasus,
+                    mm_states=mm_states,
+                    mm_rewards=mm_rewards,
+                    z_mm=z_mm if pegasus else None,
+                    z_rr=z_rr if pegasus else None,
+                    mm_groups=rollout_mm_groups,
+                    out=trajectory_buffers,
+                    compile_mm=compile_mm,
+                    **rollout_kwargs)
             # dims are timesteps x batch size x state/action/reward dims
             states, actions, rewards = trajectories
+            if isinstance(rewards, list):
+                rewards = torch.stack(rewards)
+            rewards = rewards.to(dtype)
             if debug and i % 50 == 0:
                 utils.plot_trajectories(*[
-                    torch.stack(x).transpose(0, 1).detach().cpu().numpy()
-                    for x in trajectories
+                    torch.stack(list(x)).transpose(
+                        0, 1).detach().cpu().numpy() for x in trajectories
                 ])
             if callable(on_rollout):
                 on_rollout(i, states, actions, rewards, discount)
@@ -131,17 +183,18 @@ def mc_pilco(init_states,
             continue
 
         # calculate loss. average over batch index, sum over time step index
-        discounted_rewards = torch.stack(
-            [r * discount(i) for i, r in enumerate(rewards)])
+        discounted_rewards = rewards * discount_weights[:len(rewards)]
         if value_func is not None:
             Vend = value_func(states[-1], resample=False, return_samples=True)
             discounted_rewards = torch.cat(
-                [discounted_rewards,
-                 discount(H) * Vend.unsqueeze(0)], 0)
+                [discounted_rewards, discount_weights[H] * Vend[None]], 0)
         if maximize:
             returns = -discounted_rewards.sum(0)
         else:
             returns = discounted_rewards.sum(0)
+        if K > 1:
+            # average over the parallel rollouts
+            returns = returns.view(K, N_particles, -1).mean(0)
 
         if cvar_eps > -1.0 and cvar_eps < 1.0 and cvar_eps != 0:
             if cvar_eps > 0:
@@ -169,6 +222,9 @@ def mc_pilco(init_states,
                 # this contains the norms of gradients for every particle,
                 # per time-step
                 m_norms = torch.stack(norms)
+                # average over the parallel rollouts
+                if K > 1:
+                    m_norms = m_norms.view(m_norms.shape[0], K, -1).mean(1)
                 # group by initial state
                 if mm_groups is not None:
                     m_norms = m_norms.view(-1, mm_groups,
@@ -212,12 +268,23 @@ def mc_pilco(init_states,
         # update parameters
         opt.step()
         n_opt_steps += 1
-        pbar.set_description((msg % (torch.stack(rewards).sum(0).mean())) +
+        pbar.set_description((msg % (rewards.sum(0).mean())) +
                              ' [{0}]'.format(len(rewards)))
 
         if callable(on_iteration):
             on_iteration(i, loss, states, actions, rewards, discount)
 
+        if patience is not None:
+            loss_ = loss.item()
+            running_loss = (loss_ if running_loss is None else 0.9 *
+                            running_loss + 0.1 * loss_)
+            if running_loss < best_loss:
+                best_loss, since_best = running_loss, 0
+            else:
+                since_best += 1
+            if since_best >= patience:
+                break
+
         # sample initial states
         if exp is not None:
             if prioritized_replay:
@@ -239,24 +306,15 @@ def mc_pilco(init_states,
 
                 priority_beta = max(1.0,
                                     priority_beta + priority_beta_increase)
-                x0 = torch.stack(x0).to(dynamics.X.device, dynamics.X.dtype)
+                x0 = torch.stack(x0).to(device, dtype)
                 x0_weights = torch.tensor(np.stack(x0_weights)).to(
                     x0.device, x0.dtype)
                 # print((x0_tree.counts == 1).sum(), x0_tree.counts.max())
                 x0.requires_grad_(True)
             else:
-                if mm_groups is not None:
-                    # split the initial states into groups from
-                    # different timesteps
-                    x0 = exp.sample_states(mm_groups,
-                                           timestep=step_idx_to_sample).to(
-                                               dynamics.X.device,
-                                               dynamics.X.dtype)
-                else:
-                    x0 = exp.sample_states(N_particles,
-                                           timestep=step_idx_to_sample).to(
-                                               dynamics.X.device,
-                                               dynamics.X.dtype)
+                # when mm_groups is set, the initial states are split into
+                # groups from different timesteps
+                x0 = x0_pool[(i + 1) % opt_iters]
                 init_states = x0
 
         else:
@@ -289,8 +347,10 @@ class MCPILCOAgent(torch.nn.Module):
                               batch_size,
                               step_idx_to_sample=None,
                               init_state_noise=0.0):
-        x0 = self.exp.sample_states(batch_size, timestep=step_idx_to_sample)
-        x0 = x0.to(self.dyn.X.device, self.dyn.X.dtype)
+        x0 = self.exp.sample_states(batch_size,
+                                    timestep=step_idx_to_sample,
+                                    pin_memory=self.dyn.X.is_cuda)
+        x0 = utils.to_device(x0, self.dyn.X.device, self.dyn.X.dtype)
         x0 += init_state_noise * torch.randn_like(x0)
         return x0
 
@@ -332,28 +392,40 @@ class MCPILCOAgent(torch.nn.Module):
                if maximize else "Pred. Cumm. costs: %f")
         pbar = tqdm.tqdm(range(opt_iters), total=opt_iters)
 
+        # prefetch the initial states for all iterations, so they are
+        # sampled and copied to the device only once
+        x0_pool = self.sample_initial_states(opt_iters * batch_size,
+                                             step_idx_to_sample,
+                                             init_state_noise).view(
+                                                 opt_iters, batch_size, -1)
+        init_states = x0_pool[0]
+
         # init random numbers
-        init_states = self.sample_initial_states(batch_size,
-                                                 step_idx_to_sample,
-                                                 init_state_noise)
         D = init_states.shape[-1]
         shape = init_states.shape
         dtype = init_states.dtype
         device = init_states.device
-        z_mm = torch.randn(steps + shape[0],
-                           *shape[1:]).reshape(-1, D).to(device, dtype)
-        z_rr = torch.randn(steps + shape[0], 1).reshape(-1,
-                                                        1).to(device, dtype)
+        z_all = torch.randn(steps + shape[0],
+                            D + 1,
+                            device=device,
+                            dtype=dtype)
+        z_mm, z_rr = z_all[:, :D], z_all[:, D:]
 
         # sample initial random numbers
         def resample():
             self.dyn.resample()
             self.pol.resample()
-            z_mm.normal_()
-            z_rr.normal_()
+            z_all.normal_()
 
         resample()
 
+        # discount weights for every step of the rollout
+        discount_weights = torch.tensor([discount(t) for t in range(steps)],
+                                        device=device,
+                                        dtype=dtype)[:, None, None]
+
+        # rollouts are written into buffers that are reused every iteration
+        trajectory_buffers = []
         for i in pbar:
             # zero gradients
             self.pol.zero_grad()
@@ -374,7 +446,8 @@ class MCPILCOAgent(torch.nn.Module):
                                              mm_states=mm_states,
                                              mm_rewards=mm_rewards,
                                              z_mm=z_mm if pegasus else None,
-                                             z_rr=z_rr if pegasus else None)
+                                             z_rr=z_rr if pegasus else None,
+                                             out=trajectory_buffers)
                 # dims are timesteps x batch size x state/action/reward dims
                 states, actions, rewards = trajectories
                 if debug and i % 100 == 0:
@@ -388,14 +461,12 @@ class MCPILCOAgent(torch.nn.Module):
                 print("RuntimeError")
                 # resample random numbers
                 resample()
-                init_states = self.sample_initial_states(
-                    batch_size, step_idx_to_sample, init_state_noise)
+                init_states = x0_pool[(i + 1) % opt_iters]
                 continue
 
             # calculate loss. average over batch index, sum over time step
             # index
-            discounted_rewards = torch.stack(
-                [r * discount(i) for i, r in enumerate(rewards)])
+            discounted_rewards = rewards * discount_weights[:len(rewards)]
 
             if maximize:
                 returns = -discounted_rewards.sum(0)
@@ -435,13 +506,7 @@ class MCPILCOAgent(torch.nn.Module):
                 on_iteration(i, loss, states, actions, rewards, discount)
 
             # sample initial states
-            N_particles = init_states.shape[0]
-            x0 = exp.sample_states(N_particles,
-                                   timestep=step_idx_to_sample).to(
-                                       dynamics.X.device, dynamics.X.dtype)
-            x0 += init_state_noise * torch.randn_like(x0)
-            init_states = x0
-            x0 = x0.detach()
+            init_states = x0_pool[(i + 1) % opt_iters]
 
         policy.eval()
         dynamics.eval()
@@ -24,6 +24,30 @@ from ..base import GymEnv
 from ...utils import angles
 
 
+@torch.jit.script
+def cartpole_reward_(pos, sin_theta, cos_theta, u, target, pole_length, Q, R):
+    # compute the distance between the tip of the pole and the target tip
+    # location
+    target_theta = target[:, 2:3]
+    target_tip_xy = torch.cat([
+        target[:, 0:1] + pole_length * target_theta.sin(),
+        -pole_length * target_theta.cos()
+    ], -1)
+    pole_tip_xy = torch.cat(
+        [pos + pole_length * sin_theta, -pole_length * cos_theta], -1)
+
+    # normalized distance so that cost at [0 ,0 ,0, 0] is 1
+    delta = (pole_tip_xy - target_tip_xy) / (2 * pole_length)
+
+    # compute cost
+    cost = 0.5 * ((delta.mm(Q) * delta).sum(-1, keepdim=True) +
+                  (u.mm(R) * u).sum(-1, keepdim=True))
+
+    # reward is negative cost.
+    # optimizing the exponential of the negative cost
+    return (-cost).exp()
+
+
 class CartpoleReward(torch.nn.Module):
     def __init__(self,
                  pole_length=0.5,
@@ -49,41 +73,15 @@ class CartpoleReward(torch.nn.Module):
             x = x.unsqueeze(0)
         if u.dim() == 1:
             u = u.unsqueeze(0)
-        # compute the distance between the tip of the pole and the target tip
-        # location
-        targeta = angles.to_complex(self.target, [2])
-        target_tip_xy = torch.cat([
-            targeta[:, 0, None] + self.pole_length * targeta[:, 3, None],
-            -self.pole_length * targeta[:, 4, None]
-        ],
-                                  dim=-1)
-        if x.shape[-1] != targeta.shape[-1]:
-            xa = angles.to_complex(x, [2])
+        # the states may come with the angle already expanded as sin and cos,
+        # i.e. [x, dx, dtheta, sin(theta), cos(theta)]
+        if x.shape[-1] != self.target.shape[-1]:
+            sin_theta, cos_theta = x[:, 3, None], x[:, 4, None]
         else:
-            xa = x
-        pole_tip_xy = torch.cat([
-            xa[:, 0, None] + self.pole_length * xa[:, 3, None],
-            -self.pole_length * xa[:, 4, None]
-        ],
-                                dim=-1)
-
-        pole_tip_xy = pole_tip_xy.unsqueeze(
-            0) if pole_tip_xy.dim() == 1 else pole_tip_xy
-        target_tip_xy = target_tip_xy.unsqueeze(
-            0) if target_tip_xy.dim() == 1 else target_tip_xy
-
-        # normalized distance so that cost at [0 ,0 ,0, 0] is 1
-        delta = (pole_tip_xy - target_tip_xy)
-        delta = delta / (2 * self.pole_length)
-
-        # compute cost
-        cost = 0.5 * ((delta.mm(self.Q) * delta).sum(-1, keepdim=True) +
-                      (u.mm(self.R) * u).sum(-1, keepdim=True))
-
-        # reward is negative cost.
-        # optimizing the exponential of the negative cost
-        reward = (-cost).exp()
-        return reward
+            theta = x[:, 2, None]
+            sin_theta, cos_theta = theta.sin(), theta.cos()
+        return cartpole_reward_(x[:, 0, None], sin_theta, cos_theta, u,
+                                self.target, self.pole_length, self.Q, self.R)
 
 
 class CartpoleReward2(torch.nn.Module):
@@ -12,6 +12,28 @@ from prob_mbrl.models import activations
 from ..utils.core import sin_squashing_fn
 
 
+@torch.jit.script
+def tanh_squash_(u, scale, bias):
+    # squashes the actions into [bias - scale, bias + scale] in a single
+    # fused kernel
+    return bias + scale * torch.tanh(u)
+
+
+def merge_moments_(mean, m2, N, x):
+    '''
+        Merges the mean and sum of squared deviations of the rows of x into
+        those of N previous samples (Chan et al.'s parallel form of
+        Welford's algorithm). Returns the updated mean and m2.
+    '''
+    N_new = x.shape[0]
+    N_total = N + N_new
+    var_new, mean_new = torch.var_mean(x, 0, keepdim=True, unbiased=False)
+    delta = mean_new - mean
+    mean = mean + delta * (N_new / N_total)
+    m2 = m2 + var_new * N_new + delta**2 * (N * N_new / N_total)
+    return mean, m2
+
+
 def mlp(input_dims,
         output_dims,
         hidden_dims=[200, 200],
@@ -126,24 +148,134 @@ class Regressor(torch.nn.Module):
         self.register_buffer('my', torch.zeros([1, 1]))
         self.register_buffer('Sy', torch.ones([1, 1]))
         self.register_buffer('iSy', torch.ones([1, 1]))
+        # -mx * iSx, so that normalizing the inputs is a single addcmul. it
+        # is derived from the other buffers, so it isn't saved
+        self.register_buffer('nmx_iSx', torch.zeros([1, 1]), persistent=False)
+        self._has_angles = len(angle_dims) > 0
+        # storage and running statistics used by add_data
+        self._has_data = False
+        self._X_store, self._Y_store = None, None
+        self._m2x, self._m2y = None, None
+
+    def update_input_offset(self):
+        self.nmx_iSx = -self.mx * self.iSx
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        super(Regressor, self)._load_from_state_dict(state_dict, prefix,
+                                                     *args, **kwargs)
+        self._has_data = self._has_data or prefix + 'X' in state_dict
+        self.update_input_offset()
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super(Regressor, self)._save_to_state_dict(destination, prefix,
+                                                   keep_vars)
+        # X and Y may be views of a larger storage (see add_data), which
+        # torch.save would write out in full
+        for name in ['X', 'Y']:
+            if self._buffers[name]._base is not None:
+                destination[prefix + name] = destination[prefix +
+                                                         name].clone()
 
     def set_dataset(self, X, Y, N_ensemble=-1, p=0.5):
         if len(self.angle_dims):
-            self.X.data = to_complex(X, self.angle_dims)
+            self.X = to_complex(X, self.angle_dims).detach()
         else:
-            self.X.data = X
-        self.Y.data = Y
-        self.mx.data = self.X.mean(0, keepdim=True)
-        self.Sx.data = 3.0 * self.X.std(0, keepdim=True)
-        self.Sx.data[self.Sx == 0] = 1.0
-        self.iSx.data = self.Sx.reciprocal()
-        self.my.data = self.Y.mean(0, keepdim=True)
-        self.Sy.data = 3.0 * self.Y.std(0, keepdim=True)
-        self.Sy.data[self.Sy == 0] = 1.0
-        self.iSy.data = self.Sy.reciprocal()
+            self.X = X.detach()
+        self.Y = Y.detach()
+        # std_mean computes both statistics in a single pass over the data
+        sx, self.mx = torch.std_mean(self.X, 0, keepdim=True)
+        sx = sx.mul_(3.0)
+        self.Sx = sx.masked_fill_(sx == 0, 1.0)
+        self.iSx = self.Sx.reciprocal()
+        sy, self.my = torch.std_mean(self.Y, 0, keepdim=True)
+        sy = sy.mul_(3.0)
+        self.Sy = sy.masked_fill_(sy == 0, 1.0)
+        self.iSy = self.Sy.reciprocal()
+        self.update_input_offset()
         if N_ensemble > 1:
-            self.masks.data = torch.bernoulli(
-                p * torch.ones(X.shape[0], N_ensemble))
+            self.masks = torch.bernoulli(p * torch.ones(
+                X.shape[0], N_ensemble, device=self.X.device,
+                dtype=self.X.dtype))
+            # add_data samples the masks of new points with the same p
+            self._masks_p = p
+        # the running statistics will be rebuilt on the next add_data call
+        self._has_data = True
+        self._X_store, self._Y_store = None, None
+
+    def sync_data_store(self):
+        '''
+            Makes sure that the storage used by add_data holds the current
+            dataset, and recomputes the running sums of squared deviations
+            if it doesn't (e.g. after set_dataset, load, or moving the model
+            to a different device).
+        '''
+        if (self._X_store is None or self._Y_store is None
+                or self._X_store.data_ptr() != self.X.data_ptr()
+                or self._Y_store.data_ptr() != self.Y.data_ptr()):
+            self._X_store, self._Y_store = self.X, self.Y
+            N = self.X.shape[0]
+            self._m2x = torch.var(self.X, 0, keepdim=True, unbiased=False) * N
+            self._m2y = torch.var(self.Y, 0, keepdim=True, unbiased=False) * N
+
+    def add_data(self, X, Y):
+        '''
+            Appends (X, Y) to the dataset set with set_dataset, updating
+            the normalizing statistics with Welford's online algorithm
+            (merging the statistics of the new batch), so that the cost is
+            proportional to the number of new points. The dataset is kept
+            in a storage that doubles its capacity whenever it runs out of
+            space, and self.X and self.Y are views of it. If the regressor
+            has no dataset yet, this is the same as calling set_dataset.
+            Ensemble masks created by set_dataset get new rows for the new
+            points.
+        '''
+        if not self._has_data:
+            return self.set_dataset(X, Y)
+        if self._has_angles:
+            X = to_complex(X, self.angle_dims)
+        X = X.detach().to(self.X)
+        Y = Y.detach().to(self.Y)
+        if X.shape[0] == 0:
+            return
+        if (X.shape[1:] != self.X.shape[1:]
+                or Y.shape[1:] != self.Y.shape[1:]):
+            raise ValueError(
+                "Can't add data of shapes {} and {} to a dataset of shapes {} "
+                "and {}".format(tuple(X.shape), tuple(Y.shape),
+                                tuple(self.X.shape), tuple(self.Y.shape)))
+        self.sync_data_store()
+        N_old, N_new = self.X.shape[0], X.shape[0]
+        N = N_old + N_new
+        if N > self._X_store.shape[0]:
+            capacity = max(N, 2 * self._X_store.shape[0])
+            X_store = self.X.new_empty(capacity, *self.X.shape[1:])
+            Y_store = self.Y.new_empty(capacity, *self.Y.shape[1:])
+            X_store[:N_old] = self.X
+            Y_store[:N_old] = self.Y
+            self._X_store, self._Y_store = X_store, Y_store
+        self._X_store[N_old:N] = X
+        self._Y_store[N_old:N] = Y
+        self.X = self._X_store[:N]
+        self.Y = self._Y_store[:N]
+        masks = getattr(self, 'masks', None)
+        if masks is not None and masks.shape[0] == N_old:
+            self.masks = torch.cat([
+                masks,
+                torch.bernoulli(self._masks_p *
+                                masks.new_ones(N_new, masks.shape[1]))
+            ])
+
+        # merge the statistics of the new batch into the running ones
+        self.mx, self._m2x = merge_moments_(self.mx, self._m2x, N_old, X)
+        self.my, self._m2y = merge_moments_(self.my, self._m2y, N_old, Y)
+
+        sx = (self._m2x / max(N - 1, 1)).sqrt_().mul_(3.0)
+        self.Sx = sx.masked_fill_(sx == 0, 1.0)
+        self.iSx = self.Sx.reciprocal()
+        sy = (self._m2y / max(N - 1, 1)).sqrt_().mul_(3.0)
+        self.Sy = sy.masked_fill_(sy == 0, 1.0)
+        self.iSy = self.Sy.reciprocal()
+        self.update_input_offset()
 
     def load(self, state_dict):
         params = dict(self.named_parameters())
@@ -151,6 +283,14 @@ class Regressor(torch.nn.Module):
         for k, v in state_dict.items():
             if k in params:
                 params[k].data = v.data.clone()
+        self._has_data = self._has_data or 'X' in state_dict
+        self.update_input_offset()
+        self._has_angles = len(self.angle_dims) > 0
+        # resync the float copies of the buffers we just overwrote
+        [
+            m.update_float_mirrors() for m in self.modules()
+            if hasattr(m, 'update_float_mirrors')
+        ]
 
     def regularization_loss(self):
         return self.model.regularization_loss()
@@ -164,11 +304,13 @@ class Regressor(torch.nn.Module):
         ''' This assumes that the newtork outputs the parameters for
             an isotropic Gaussian predictive distribution, for each
             batch sample'''
-        if len(self.angle_dims) > 0:
+        # skip the angle encoding if there are no angles, or if the inputs
+        # have already been encoded
+        if self._has_angles and x.shape[-1] != self.X.shape[-1]:
             x = to_complex(x, self.angle_dims)
         # scale and center inputs
         if normalize:
-            x = (x - self.mx) * self.iSx
+            x = torch.addcmul(self.nmx_iSx, x, self.iSx)
         outs = self.model(x, **kwargs)
         if callable(self.output_density):
             scaling_params = (self.my, self.Sy) if normalize else None
@@ -196,6 +338,21 @@ class Policy(torch.nn.Module):
         bias = 0.5 * (maxU + minU)
         self.register_buffer('scale', torch.tensor(scale).squeeze())
         self.register_buffer('bias', torch.tensor(bias).squeeze())
+        self._has_angles = len(angle_dims) > 0
+        self.update_float_mirrors()
+
+    def update_float_mirrors(self):
+        '''
+            Keeps python float copies of scalar action scales and biases,
+            so that squashing the actions doesn't broadcast 0-d tensors.
+        '''
+        self._scale_float = (float(self.scale)
+                             if self.scale.dim() == 0 else None)
+        self._bias_float = float(self.bias) if self.bias.dim() == 0 else None
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super(Policy, self)._load_from_state_dict(*args, **kwargs)
+        self.update_float_mirrors()
 
     def regularization_loss(self):
         return self.model.regularization_loss()
@@ -209,20 +366,67 @@ class Policy(torch.nn.Module):
         for k, v in state_dict.items():
             if k in params:
                 params[k].data = v.data.clone()
+        self._has_angles = len(self.angle_dims) > 0
+        # resync the float copies of the buffers we just overwrote
+        [
+            m.update_float_mirrors() for m in self.modules()
+            if hasattr(m, 'update_float_mirrors')
+        ]
+
+    def freeze(self):
+        '''
+            Returns a function that evaluates a frozen TorchScript trace of
+            the policy, where the currently sampled dropout masks and output
+            noise are baked in as constants. This is meant for evaluating
+            the policy one state at a time (e.g. with apply_controller). Call
+            resample() before freeze() to get a new sample of the policy.
+            Tracing and freezing takes much longer than a forward pass, so
+            this only pays off when the frozen policy is evaluated for many
+            steps.
+        '''
+        fc = next(m for m in self.model.modules()
+                  if isinstance(m, torch.nn.Linear))
+        D = fc.in_features - len(self.angle_dims)
+        x = torch.zeros(1, D, dtype=self.scale.dtype, device=self.scale.device)
+        training = self.training
+        fixed_noise_policy = FixedNoisePolicy(self).eval()
+        with torch.no_grad():
+            # run the policy once, so that any dropout masks that haven't
+            # been sized for this input are sampled now, instead of in the
+            # trace (where sampling would be recorded and redone every call)
+            fixed_noise_policy(x)
+            frozen = torch.jit.trace(fixed_noise_policy, x)
+            if hasattr(torch.jit, 'freeze'):
+                frozen = torch.jit.freeze(frozen)
+        self.train(training)
+
+        def frozen_policy(x, **kwargs):
+            return_numpy = isinstance(x, np.ndarray)
+            x = torch.as_tensor(x,
+                                dtype=self.scale.dtype,
+                                device=self.scale.device)
+            if x.dim() == 1:
+                x = x[None, :]
+            with torch.no_grad():
+                u = frozen(x)
+            return u.cpu().numpy() if return_numpy else u
+
+        return frozen_policy
 
     def forward(self, x, **kwargs):
         return_numpy = isinstance(x, np.ndarray)
         kwargs['resample'] = kwargs.get('resample', True)
         kwargs['return_samples'] = kwargs.get('return_samples', True)
         if return_numpy:
-            x = torch.tensor(x,
-                             dtype=self.scale.dtype,
-                             device=self.scale.device)
+            # shares memory with x if it is on the cpu with the right dtype
+            x = torch.as_tensor(x,
+                                dtype=self.scale.dtype,
+                                device=self.scale.device)
         else:
             x = x.to(dtype=self.scale.dtype, device=self.scale.device)
         if x.dim() == 1:
             x = x[None, :]
-        if len(self.angle_dims) > 0:
+        if self._has_angles:
             x = to_complex(x, self.angle_dims)
         u = self.model(x, **kwargs)
 
@@ -232,7 +436,10 @@ class Policy(torch.nn.Module):
 
         # saturate output
         # u = self.scale * sin_squashing_fn(u * 2 / 3.0) + self.bias
-        u = self.scale * u.tanh() + self.bias
+        if self._scale_float is not None and self._bias_float is not None:
+            u = (u.tanh() * self._scale_float).add_(self._bias_float)
+        else:
+            u = tanh_squash_(u, self.scale, self.bias)
 
         if return_numpy:
             return u.detach().cpu().numpy()
@@ -240,6 +447,19 @@ class Policy(torch.nn.Module):
             return u
 
 
+class FixedNoisePolicy(torch.nn.Module):
+    '''
+        Evaluates a policy without resampling its dropout masks or its
+        output noise. Used for tracing the policy in Policy.freeze.
+    '''
+    def __init__(self, policy):
+        super(FixedNoisePolicy, self).__init__()
+        self.policy = policy
+
+    def forward(self, x):
+        return self.policy(x, resample=False, resample_noise=False)
+
+
 class DynamicsModel(Regressor):
     def __init__(self, model, reward_func=None, predict_done=False, **kwargs):
         super(DynamicsModel, self).__init__(model, **kwargs)
@@ -250,9 +470,16 @@ class DynamicsModel(Regressor):
     def set_dataset(self, X, Y):
         super(DynamicsModel, self).set_dataset(X, Y)
         D = self.Y.shape[-1] - 1
-        R = self.Y.index_select(-1, torch.tensor(D, device=self.Y.device))
-        self.maxR.data = R.max()
-        self.minR.data = R.min()
+        R = self.Y[..., D:D + 1]
+        self.maxR = R.max()
+        self.minR = R.min()
+
+    def add_data(self, X, Y):
+        super(DynamicsModel, self).add_data(X, Y)
+        D = self.Y.shape[-1] - 1
+        R = self.Y[-Y.shape[0]:, D:D + 1]
+        self.maxR = torch.max(self.maxR, R.max())
+        self.minR = torch.min(self.minR, R.min())
 
     def forward(self, inputs, separate_outputs=False, deltas=True, **kwargs):
         inputs_as_tuple = isinstance(inputs, tuple) or isinstance(inputs, list)
@@ -278,13 +505,20 @@ class DynamicsModel(Regressor):
         if not inputs_as_tuple:
             D = outs.shape[-1]
             prev_states, actions = inputs.split(D, -1)
+        else:
+            D = prev_states.shape[-1]
 
         if callable(self.reward_func):
             # if we have a known reward function
             dstates = outs
             rewards = self.reward_func(prev_states + dstates, actions)
         else:
+            if deltas and not separate_outputs:
+                # outs already has the layout of the output; no need to
+                # split it and concatenate it back
+                return outs
             # assume rewards come from the last dimension of the output
+            # (split returns views, so this doesn't copy)
             dstates, rewards = outs.split(D, -1)
 
         states = dstates if deltas else prev_states + dstates
@@ -6,6 +6,20 @@ from torch.nn import Parameter
 jit_scripts = {}
 
 
+@torch.jit.script
+def concrete_probs_(logit_p, noise, temp: float):
+    # logit_p + log(u / (1 - u)), with u nudged away from 0 and 1
+    concrete_p = logit_p + torch.log(noise + 1e-7) - torch.log1p(1e-7 - noise)
+    return torch.sigmoid(concrete_p / temp)
+
+
+@torch.jit.script
+def apply_mask_(x, mask, p: float):
+    # masking and rescaling in a single fused kernel. the masks are
+    # sampled outside, since scripted dropout sampling is not reliable
+    return x * mask / p
+
+
 class StochasticModule(torch.nn.Module):
     def __init__(self, *args, **kwargs):
         super(StochasticModule, self).__init__(*args, **kwargs)
@@ -22,16 +36,66 @@ class BDropout(StochasticModule):
         self.name = name
         self.register_buffer('regularizer_scale',
                              torch.tensor(0.5 * regularizer_scale))
-        self.register_buffer('rate', torch.tensor(rate))
-        self.register_buffer('p', 1 - self.rate)
+        # we store the keep probability, rather than the dropout rate,
+        # since p is what every op uses
+        self.register_buffer('p', 1 - torch.tensor(rate))
         self.register_buffer('noise', torch.bernoulli(self.p))
+        self.update_float_mirrors()
+
+    @property
+    def rate(self):
+        return 1 - self.p
+
+    @rate.setter
+    def rate(self, rate):
+        self.p = 1 - torch.as_tensor(
+            rate, dtype=self.p.dtype, device=self.p.device)
+        self.update_p_float()
+
+    def update_p_float(self):
+        '''
+            Keeps a python float copy of a scalar keep probability, so that
+            sampling masks doesn't need to read the p tensor.
+        '''
+        # CDropout's p may be attached to the graph of logit_p
+        self._p_float = (float(self.p.detach())
+                         if self.p.dim() == 0 else None)
+
+    def update_float_mirrors(self):
+        '''
+            Keeps python float copies of the scalar buffers, so that the
+            ops that use them take plain scalars instead of 0-d tensors.
+            This needs to be called whenever the buffers are overwritten.
+        '''
+        self.update_p_float()
+        self._reg_scale_float = float(self.regularizer_scale)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older versions also saved the dropout rate as a buffer
+        rate = state_dict.pop(prefix + 'rate', None)
+        if rate is not None and prefix + 'p' not in state_dict:
+            state_dict[prefix + 'p'] = 1 - rate
+        super(BDropout, self)._load_from_state_dict(state_dict, prefix, *args,
+                                                    **kwargs)
+        self.update_float_mirrors()
+
+    def weighted_sq_norm(self, p, weights):
+        '''
+            Returns sum_j p_j*||W_j||^2, where W_j are the weights applied
+            to the j-th input unit. With a scalar p, this is a single dot
+            product that doesn't materialize the squared weights.
+        '''
+        if p.dim() == 0:
+            w = weights.reshape(-1)
+            return p * w.dot(w)
+        return (p * (weights * weights).sum(0)).sum()
 
     def weights_regularizer(self, weights):
-        self.p = 1 - self.rate
-        return self.regularizer_scale * (self.p * (weights**2).sum(0)).sum()
+        return self._reg_scale_float * self.weighted_sq_norm(self.p, weights)
 
     def biases_regularizer(self, biases):
-        return self.regularizer_scale * ((biases**2).sum(0)).sum()
+        b = biases.reshape(-1)
+        return self._reg_scale_float * b.dot(b)
 
     def resample(self, seed=None):
         self.update_noise(self.noise, seed)
@@ -39,8 +103,14 @@ class BDropout(StochasticModule):
     def update_noise(self, x, seed=None):
         if seed is not None:
             torch.manual_seed(seed)
-        self.p = 1 - self.rate
-        self.noise.data = torch.bernoulli(self.p.expand(x.shape))
+        p = self.p if self._p_float is None else self._p_float
+        # rand_like keeps the memory layout of x, so that the masking
+        # kernels stay on their fast path for non-contiguous inputs. the
+        # mask is sampled by thresholding uniform noise, which is cheaper
+        # than bernoulli_, and stored as bool, a quarter of the size of a
+        # float mask. it gets promoted to the dtype of the inputs when it is
+        # applied
+        self.noise = torch.rand_like(x, dtype=self.p.dtype) < p
 
     def forward(self, x, resample=True, mask_dims=2, seed=None, **kwargs):
         sample_shape = x.shape[-mask_dims:]
@@ -49,15 +119,29 @@ class BDropout(StochasticModule):
             # resample if we can't re-use old numbers
             # this happens when the incoming batch size is bigger than
             # the noise batch size, or when the rest of the shape differs
-            sample = x.view(-1, *sample_shape)[0]
-            self.update_noise(sample, seed)
+            # only the shape of the template matters, so there is no need
+            # to index (or copy, if non-contiguous) the input
+            self.update_noise(x.new_empty(sample_shape), seed)
         elif resample:
             if seed is not None:
                 torch.manual_seed(seed)
-            return (x * torch.bernoulli(self.p.expand(x.shape))) / self.p
+            if self._p_float is not None:
+                # with a fresh mask and a scalar rate, this is standard
+                # dropout (including the 1/p scaling), so use the fused
+                # kernel. this applies in eval mode too, as we want MC
+                # samples from the network
+                return nn.functional.dropout(x,
+                                             1 - self._p_float,
+                                             training=True)
+            mask = torch.rand_like(x, dtype=self.p.dtype) < self.p
+            # cast p so that low precision inputs are not upcast
+            return x * mask / self.p.to(x.dtype)
 
         # we never need the noise gradients
-        return (x * self.noise[..., :x.shape[-mask_dims], :].detach()) / self.p
+        noise = self.noise[..., :x.shape[-mask_dims], :].detach()
+        if self._p_float is not None:
+            return apply_mask_(x, noise, self._p_float)
+        return (x * noise) / self.p.to(x.dtype)
 
     def extra_repr(self):
         if self.rate.dim() >= 1 and len(self.rate) > 1:
@@ -83,18 +167,48 @@ class CDropout(BDropout):
                              torch.tensor(dropout_regularizer))
         self.logit_p = Parameter(-torch.log(1.0 / self.p - 1.0))
         self.register_buffer('concrete_noise', torch.bernoulli(self.p))
+        self.update_float_mirrors()
+
+    def update_float_mirrors(self):
+        super(CDropout, self).update_float_mirrors()
+        # logit_p may have been overwritten without bumping its version
+        # (e.g. by load), so drop the cached keep probabilities
+        self._p_key = None
+        # the base class constructor runs this before temp is registered
+        if hasattr(self, 'temp'):
+            self._temp_float = float(self.temp)
+            self._dropout_reg_float = float(self.dropout_regularizer)
+
+    def _p(self):
+        '''
+            Returns the keep probabilities, sigmoid(logit_p). With autograd
+            enabled, these are recomputed on every call, so that every loss
+            gets its own graph. Otherwise, they are only recomputed when
+            logit_p has been modified in place (e.g. by an optimizer step).
+        '''
+        if torch.is_grad_enabled():
+            self._p_key = None
+            self.p = self.logit_p.sigmoid()
+        elif self._p_key != self.logit_p._version:
+            self.p = self.logit_p.sigmoid()
+            self._p_key = self.logit_p._version
+        return self.p
 
     def weights_regularizer(self, weights):
-        p = self.p
-        reg = self.regularizer_scale * (p * (weights**2).sum(0))
-        reg += self.dropout_regularizer * (p * p.log() + (1 - p) *
-                                           (1 - p).log())
-        return reg.sum()
+        p = self._p()
+        reg = self._reg_scale_float * self.weighted_sq_norm(p, weights)
+        neg_entropy = p * p.log() + (1 - p) * (1 - p).log()
+        if p.dim() == 0:
+            # a scalar rate is shared by every input unit
+            neg_entropy = neg_entropy * weights[0].numel()
+        else:
+            neg_entropy = neg_entropy.sum()
+        return reg + self._dropout_reg_float * neg_entropy
 
     def update_noise(self, x, seed=None):
         if seed is not None:
             torch.manual_seed(seed)
-        self.noise.data = torch.rand_like(x)
+        self.noise = torch.empty_like(x).uniform_()
         if not self.training:
             self.update_concrete_noise(self.noise)
 
@@ -104,17 +218,15 @@ class CDropout(BDropout):
         Args:
             noise (Tensor): Input.
         """
-        noise_p = noise + 1e-7
-        noise_m = noise - 1e-7
-
-        concrete_p = self.logit_p + (noise_p / (1 - noise_m)).log()
-        probs = (concrete_p / self.temp).sigmoid()
+        # the noise has the dtype of the inputs, so cast the probabilities
+        # to avoid upcasting low precision inputs when applying the masks
+        probs = concrete_probs_(self.logit_p, noise,
+                                self._temp_float).to(noise.dtype)
 
         # forward pass uses bernoulli sampled noise, but backwards
         # through concrete distribution
         noise = torch.bernoulli(probs)
         self.concrete_noise = (noise - probs).detach() + probs
-        self.p = self.logit_p.sigmoid()
 
     def forward(self, x, resample=False, mask_dims=2, seed=None, **kwargs):
         """Computes the concrete dropout.
@@ -134,7 +246,7 @@ class CDropout(BDropout):
         if resample:
             if seed is not None:
                 torch.manual_seed(seed)
-            noise = torch.rand_like(x)
+            noise = torch.empty_like(x).uniform_()
             resampled = True
         elif (sample_shape[1:] != self.noise.shape[1:]
               or sample_shape[1:] != self.concrete_noise.shape[1:]
@@ -142,8 +254,9 @@ class CDropout(BDropout):
             # resample if we can't re-use old numbers
             # this happens when the incoming batch size is bigger than
             # the noise batch size, or when the rest of the shape differs
-            sample = x.view(-1, *sample_shape)[0]
-            self.update_noise(sample, seed)
+            # only the shape of the template matters, so there is no need
+            # to index (or copy, if non-contiguous) the input
+            self.update_noise(x.new_empty(sample_shape), seed)
             noise = self.noise
             resampled = True
 
@@ -159,15 +272,14 @@ class CDropout(BDropout):
         return x * concrete_noise[..., :x.shape[-mask_dims], :]
 
     def extra_repr(self):
-        self.rate = 1 - self.logit_p.sigmoid().detach()
-        if self.rate.dim() >= 1 and len(self.rate) > 1:
+        rate = 1 - self._p().detach()
+        if rate.dim() >= 1 and len(rate) > 1:
             desc = 'rate=[mean: {}, min: {}, max: {}], regularizer_scale={}'
-            return desc.format(self.rate.mean(), self.rate.min(),
-                               self.rate.max(), self.temp,
+            return desc.format(rate.mean(), rate.min(), rate.max(), self.temp,
                                self.regularizer_scale)
         else:
             return 'rate={}, temperature={}, regularizer_scale={}'.format(
-                1 - self.logit_p.sigmoid(), self.temp, self.regularizer_scale)
+                rate, self.temp, self.regularizer_scale)
 
 
 class TLNDropout(BDropout):
@@ -201,6 +313,31 @@ class BSequential(nn.modules.Sequential):
     def __init__(self, *args):
         super(BSequential, self).__init__(*args)
 
+    def invalidate_plans(self):
+        '''
+            Drops the cached forward plan and regularizer pairs. This is
+            called by every method that changes the modules in the sequence.
+        '''
+        self._plan = None
+        self._reg_pairs = None
+
+    def add_module(self, name, module):
+        super(BSequential, self).add_module(name, module)
+        self.invalidate_plans()
+
+    def __setitem__(self, idx, module):
+        super(BSequential, self).__setitem__(idx, module)
+        self.invalidate_plans()
+
+    def __delitem__(self, idx):
+        super(BSequential, self).__delitem__(idx)
+        self.invalidate_plans()
+
+    def insert(self, index, module):
+        ret = super(BSequential, self).insert(index, module)
+        self.invalidate_plans()
+        return ret
+
     def resample(self, seed=None):
         i = 0
         for module in self._modules.values():
@@ -211,17 +348,20 @@ class BSequential(nn.modules.Sequential):
                     module.resample()
                 i += 1
 
+    def get_forward_plan(self):
+        '''
+            Returns a list of (module, is_stochastic) pairs, in the order in
+            which the modules are evaluated. The list is cached until the
+            modules in the sequence change.
+        '''
+        if getattr(self, '_plan', None) is None:
+            self._plan = [(module, isinstance(module, StochasticModule))
+                          for module in self._modules.values()]
+        return self._plan
+
     def forward(self, input, resample=True, repeat_mask=False, **kwargs):
-        modules = list(self._modules.values())
-        for i, module in enumerate(modules):
-            if isinstance(module, BDropout) or isinstance(
-                    module, torch.nn.Dropout):
-                if i < len(modules):
-                    next_module = modules[i + 1]
-                    if isinstance(next_module, SpectralNorm):
-                        # rescale lipschitz constant by dropout probability
-                        pass
-            if isinstance(module, StochasticModule):
+        for module, is_stochastic in self.get_forward_plan():
+            if is_stochastic:
                 input = module(input,
                                resample=resample,
                                repeat_mask=repeat_mask,
@@ -230,29 +370,44 @@ class BSequential(nn.modules.Sequential):
                 input = module(input)
         return input
 
+    def get_reg_pairs(self):
+        '''
+            Returns a list of (module, weights_module) pairs, where every
+            module with a weights regularizer is paired with the first
+            subsequent layer with weights, and every other module with its
+            own regularization loss is paired with None. The list is cached
+            until the modules in the sequence change.
+        '''
+        if getattr(self, '_reg_pairs', None) is None:
+            modules = list(self._modules.values())
+            reg_pairs = []
+            for i, module in enumerate(modules):
+                if hasattr(module, 'weights_regularizer'):
+                    # find first subsequent module, from current,
+                    # with a weight attribute
+                    for next_module in modules[i:]:
+                        if isinstance(next_module, SpectralNorm):
+                            next_module = next_module.module
+                        if isinstance(next_module, nn.Linear)\
+                                or isinstance(next_module,
+                                              nn.modules.conv._ConvNd):
+                            reg_pairs.append((module, next_module))
+                            break
+                elif hasattr(module, 'regularization_loss'):
+                    reg_pairs.append((module, None))
+            self._reg_pairs = reg_pairs
+        return self._reg_pairs
+
     def regularization_loss(self):
-        modules = list(self._modules.values())
         reg_loss = 0
-        for i, module in enumerate(modules):
-            if hasattr(module, 'weights_regularizer'):
-                # find first subsequent module, from current,output_samples
-                # with a weight attribute
-                for next_module in modules[i:]:
-                    if isinstance(next_module, SpectralNorm):
-                        next_module = next_module.module
-                    if isinstance(next_module, nn.Linear)\
-                            or isinstance(next_module,
-                                          nn.modules.conv._ConvNd):
-                        reg_loss += module.weights_regularizer(
-                            next_module.weight)
-                        if hasattr(next_module, 'bias')\
-                                and next_module.bias is not None\
-                                and hasattr(module, 'biases_regularizer'):
-                            reg_loss += module.biases_regularizer(
-                                next_module.bias)
-                        break
-            elif hasattr(module, 'regularization_loss'):
+        for module, next_module in self.get_reg_pairs():
+            if next_module is None:
                 reg_loss += module.regularization_loss()
+                continue
+            reg_loss += module.weights_regularizer(next_module.weight)
+            if getattr(next_module, 'bias', None) is not None\
+                    and hasattr(module, 'biases_regularizer'):
+                reg_loss += module.biases_regularizer(next_module.bias)
         return reg_loss
 
 
@@ -294,9 +449,9 @@ class SpectralNorm(torch.nn.Module):
         M = w.shape[0]
         N = w.view(M, -1).shape[0]
         u = torch.randn(M).to(w.device, w.dtype)
-        u.data = u / (u.norm() + 1e-12)
+        u = u / (u.norm() + 1e-12)
         v = torch.randn(N).to(w.device, w.dtype)
-        v.data = v / (v.norm() + 1e-12)
+        v = v / (v.norm() + 1e-12)
 
         self.module.register_parameter(self.param_name + "_bar", w_sn)
         self.module.register_buffer(self.param_name + "_u", u)
@@ -1,8 +1,10 @@
 from .core import (plot_sample, plot_mean_var, plot_trajectories, plot_rollout,
                    batch_jacobian, polyak_averaging, sin_squashing_fn, tile,
-                   load_csv, load_checkpoint)
-from .train_regressor import train_regressor, iterate_minibatches
-from .rollout import rollout, rollout_with_values, rollout_with_Qvalues
+                   to_device, load_csv, load_checkpoint)
+from .train_regressor import (train_regressor, iterate_minibatches,
+                              episode_errors)
+from .rollout import (rollout, rollout_with_values, rollout_with_Qvalues,
+                      autocast)
 from .experience_dataset import ExperienceDataset, SumTree
 from .apply_controller import apply_controller
 from . import (classproperty, angles)
@@ -10,7 +12,9 @@ from . import (classproperty, angles)
 __all__ = [
     "iterate_minibatches", "plot_sample", "plot_mean_var", "plot_trajectories",
     "plot_rollout", "batch_jacobian", "polyak_averaging", "sin_squashing_fn",
-    "load_csv", "tile", "load_checkpoint", "classproperty", "angles",
+    "load_csv", "tile", "to_device", "load_checkpoint", "classproperty",
+    "angles",
     "ExperienceDataset", "SumTree", "apply_controller", "custom_pbar",
-    "train_regressor", "rollout", "rollout_with_values", "rollout_with_Qvalues"
+    "train_regressor", "episode_errors", "rollout", "rollout_with_values",
+    "rollout_with_Qvalues", "autocast"
 ]
@@ -1,6 +1,7 @@
 # pylint: disable=C0103
 import numpy as np
 import time
+import torch
 
 
 def apply_controller(env,
@@ -42,41 +43,42 @@ def apply_controller(env,
     # applying action at time t
     data = []
 
-    # do rollout
+    # do rollout. no gradients are needed when interacting with the env
     t_ = time.time()
-    for t in range(max_steps):
-        # preprocess state
-        x_t_ = preprocess(x_t) if callable(preprocess) else x_t
-
-        #  get command from policy
-        u_t = policy(x_t_, t=t)
-        if isinstance(u_t, list) or isinstance(u_t, tuple):
-            u_t = u_t[0].flatten()
-        else:
-            u_t = u_t.flatten()
-
-        # apply control and step the env
-        x_next, c_t, done, info = env.step(u_t)
-        info['done'] = done
-
-        # append to dataset
-        data.append((x_t, u_t, c_t, done, info))
-
-        # send data to callback
-        if callable(callback):
-            callback(x_t, u_t, c_t, done, info)
-
-        # break if done
-        if done and stop_when_done:
-            break
-
-        # replace current state
-        x_t = x_next
-
-        exec_time = time.time() - t_
-        if realtime:
-            time.sleep(max(float(dt - exec_time), 0))
-        t_ = time.time()
+    with torch.no_grad():
+        for t in range(max_steps):
+            # preprocess state
+            x_t_ = preprocess(x_t) if callable(preprocess) else x_t
+
+            #  get command from policy
+            u_t = policy(x_t_, t=t)
+            if isinstance(u_t, list) or isinstance(u_t, tuple):
+                u_t = u_t[0].flatten()
+            else:
+                u_t = u_t.flatten()
+
+            # apply control and step the env
+            x_next, c_t, done, info = env.step(u_t)
+            info['done'] = done
+
+            # append to dataset
+            data.append((x_t, u_t, c_t, done, info))
+
+            # send data to callback
+            if callable(callback):
+                callback(x_t, u_t, c_t, done, info)
+
+            # break if done
+            if done and stop_when_done:
+                break
+
+            # replace current state
+            x_t = x_next
+
+            exec_time = time.time() - t_
+            if realtime:
+                time.sleep(max(float(dt - exec_time), 0))
+            t_ = time.time()
 
     states, actions, costs, dones, infos = zip(*data)
 
@@ -180,6 +180,21 @@ def sin_squashing_fn(x):
     return 0.125 * (xx * scale).sum(0)
 
 
+def to_device(x, device, dtype=None):
+    '''
+        Converts x to a tensor of the given dtype on the given device. When
+        copying from the cpu to a cuda device, the data goes through pinned
+        memory so that the copy is asynchronous.
+    '''
+    x = torch.as_tensor(x, dtype=dtype)
+    device = torch.device(device)
+    if device.type == 'cuda' and x.device.type == 'cpu':
+        if not x.is_pinned():
+            x = x.pin_memory()
+        return x.to(device, non_blocking=True)
+    return x.to(device)
+
+
 def tile(tensor, n):
     return tensor.unsqueeze(0).transpose(0, 1).repeat(1, 1, n).view(
         n * tensor.shape[0], -1)
@@ -18,8 +18,10 @@ class ExperienceDataset(torch.nn.Module):
         self.done = []
         self.info = []
         self.policy_parameters = []
+        self.priorities = []
         self.curr_episode = -1
         self.state_changed = True
+        self.dataset_cache = {}
 
     def add_sample(self,
                    x_t=None,
@@ -55,6 +57,7 @@ class ExperienceDataset(torch.nn.Module):
             self.policy_parameters.append(policy_params)
         else:
             self.policy_parameters.append([])
+        self.priorities.append(self.max_priority())
 
         self.curr_episode += 1
         self.state_changed = True
@@ -78,6 +81,7 @@ class ExperienceDataset(torch.nn.Module):
         self.states.append(states)
         self.actions.append(actions)
         self.rewards.append(rewards)
+        self.priorities.append(self.max_priority())
         self.curr_episode += 1
 
     def n_samples(self):
@@ -99,7 +103,9 @@ class ExperienceDataset(torch.nn.Module):
         self.rewards = []
         self.info = []
         self.policy_parameters = []
+        self.priorities = []
         self.curr_episode = -1
+        self.dataset_cache = {}
         # Let's give people a last chance of recovering their data. Also, we
         # don't want to save an empty experience dataset
         self.state_changed = False
@@ -118,6 +124,8 @@ class ExperienceDataset(torch.nn.Module):
             self.done = self.done[episode:]
             self.info = self.info[episode:]
             self.policy_parameters = self.policy_parameters[episode:]
+            self.priorities = self.priorities[episode:]
+            self.dataset_cache = {}
 
     def get_dynmodel_dataset(self,
                              deltas=True,
@@ -159,7 +167,6 @@ class ExperienceDataset(torch.nn.Module):
         filter_episodes = filter_episodes or []
         angle_dims = angle_dims or []
         inputs, targets = [], []
-        join = torch.stack if stack else torch.cat
         if stack:
             # ignore the u_steps parameter
             u_steps = x_steps
@@ -171,82 +178,150 @@ class ExperienceDataset(torch.nn.Module):
         if len(filter_episodes) < 1:
             # use all data
             filter_episodes = list(range(self.n_episodes()))
+        if not hasattr(self, 'dataset_cache'):
+            self.dataset_cache = {}
         for epi in filter_episodes:
             if len(self.states[epi]) == 0:
                 continue
-            # get state action pairs for current episode
-            states, actions = torch.tensor(
-                self.states[epi]).double(), torch.tensor(
-                    self.actions[epi]).double()
-            # convert input angle dimensions to complex representation
-            states_ = angles.to_complex(states, angle_dims)
-            # pad with initial state for the first x_steps timesteps
-            states_ = torch.cat([states_[[0] * (x_steps - 1)], states_], 0)
-            # get input states up to x_steps in the past.
-            states_ = join([
-                states_[i:i - x_steps - (output_steps - 1), :]
-                for i in range(x_steps)
-            ],
-                           dim=1)
-            # same for actions (u_steps in the past, pad with zeros for the
-            # first u_steps)
-            actions_ = torch.cat([
-                torch.zeros((u_steps - 1, actions.shape[1])).double(), actions
-            ])
-            actions_ = join([
-                actions_[i:i - u_steps - (output_steps - 1), :]
-                for i in range(u_steps)
-            ],
-                            dim=1)
+            # episodes only change by having samples appended, so the
+            # processed data is reused until the episode length changes
+            key = (epi, deltas, tuple(angle_dims), x_steps, u_steps,
+                   output_steps, return_costs, stack)
+            H = len(self.states[epi])
+            if key not in self.dataset_cache or self.dataset_cache[key][
+                    0] != H:
+                self.dataset_cache[key] = (H,
+                                           self.get_episode_dataset(
+                                               epi, deltas, angle_dims,
+                                               x_steps, u_steps, output_steps,
+                                               return_costs, stack))
+            inp, tgt = self.dataset_cache[key][1]
+            inputs.append(inp)
+            targets.append(tgt)
 
-            # create input vector
-            inp = torch.cat([states_, actions_], dim=-1)
+        ret = torch.cat(inputs).detach(), torch.cat(targets).detach()
+        return ret
 
-            # get output states up to output_steps in the future
-            H = states.shape[0]
-            ostates = join([
-                states[i:H - (output_steps - i - 1), :]
+    def get_episode_dataset(self, epi, deltas, angle_dims, x_steps, u_steps,
+                            output_steps, return_costs, stack):
+        '''
+        Returns the inputs and outputs of get_dynmodel_dataset for a single
+        episode.
+        '''
+        join = torch.stack if stack else torch.cat
+        # get state action pairs for current episode
+        states = torch.from_numpy(np.asarray(self.states[epi],
+                                             dtype=np.float64))
+        actions = torch.from_numpy(
+            np.asarray(self.actions[epi], dtype=np.float64))
+        # convert input angle dimensions to complex representation
+        states_ = angles.to_complex(states, angle_dims)
+        # pad with initial state for the first x_steps timesteps
+        states_ = torch.cat([states_[[0] * (x_steps - 1)], states_], 0)
+        # get input states up to x_steps in the past.
+        states_ = join([
+            states_[i:i - x_steps - (output_steps - 1), :]
+            for i in range(x_steps)
+        ],
+                       dim=1)
+        # same for actions (u_steps in the past, pad with zeros for the
+        # first u_steps)
+        actions_ = torch.cat([
+            torch.zeros((u_steps - 1, actions.shape[1])).double(), actions
+        ])
+        actions_ = join([
+            actions_[i:i - u_steps - (output_steps - 1), :]
+            for i in range(u_steps)
+        ],
+                        dim=1)
+
+        # create input vector
+        inp = torch.cat([states_, actions_], dim=-1)
+
+        # get output states up to output_steps in the future
+        H = states.shape[0]
+        ostates = join([
+            states[i:H - (output_steps - i - 1), :]
+            for i in range(output_steps)
+        ],
+                       dim=1)
+
+        #  create output vector
+        tgt = (ostates[1:, :] - ostates[:-1, :] if deltas else ostates[1:, :])
+
+        # append rewards if requested
+        if return_costs:
+            rewards = torch.from_numpy(
+                np.asarray(self.rewards[epi], dtype=np.float64)).squeeze(-1)
+            if rewards.dim() == 1:
+                rewards = rewards.unsqueeze(1)
+            ocosts = join([
+                rewards[i:H - (output_steps - i - 1), :]
                 for i in range(output_steps)
             ],
-                           dim=1)
+                          dim=1)
 
-            #  create output vector
-            tgt = (ostates[1:, :] -
-                   ostates[:-1, :] if deltas else ostates[1:, :])
+            tgt = torch.cat([tgt, ocosts[:-1, :]], dim=-1)
 
-            # append rewards if requested
-            if return_costs:
-                rewards = torch.tensor(self.rewards[epi]).double().squeeze(-1)
-                if rewards.dim() == 1:
-                    rewards = rewards.unsqueeze(1)
-                ocosts = join([
-                    rewards[i:H - (output_steps - i - 1), :]
-                    for i in range(output_steps)
-                ],
-                              dim=1)
+        return inp.detach(), tgt.detach()
 
-                tgt = torch.cat([tgt, ocosts[:-1, :]], dim=-1)
+    def max_priority(self):
+        ''' Returns the priority given to newly added episodes '''
+        priorities = getattr(self, 'priorities', [])
+        return max(priorities) if len(priorities) > 0 else 1.0
 
-            inputs.append(inp)
-            targets.append(tgt)
+    def get_priorities(self):
+        ''' Returns the sampling priority of every episode '''
+        priorities = list(getattr(self, 'priorities', []))
+        # datasets saved without priorities start with uniform priorities
+        missing = self.n_episodes() - len(priorities)
+        priorities += [self.max_priority()] * missing
+        return np.array(priorities[:self.n_episodes()])
 
-        ret = torch.cat(inputs).detach(), torch.cat(targets).detach()
-        return ret
+    def set_priorities(self, errors, alpha=0.6, eps=1e-8):
+        '''
+            Sets the sampling priority of every episode from an error
+            measure, as (error + eps)^alpha. e.g. the prediction errors of
+            the dynamics model on each episode.
+        '''
+        self.priorities = ((np.asarray(errors) + eps)**alpha).tolist()
 
-    def sample_states(self, n_samples=1, timestep=0):
+    def sample_states(self,
+                      n_samples=1,
+                      timestep=0,
+                      pin_memory=False,
+                      prioritized=False):
+        '''
+            Samples n_samples states from the given timesteps. If
+            prioritized is True, states are drawn from each episode with
+            probability proportional to the episode's priority.
+        '''
         # collect initial states
         if timestep is None:
-            x0 = np.concatenate(self.states)
+            x0 = [ep for ep in self.states]
         else:
             if not isinstance(timestep, collections.Iterable):
                 timestep = [timestep]
 
-            x0 = np.concatenate([[ep[t] for t in timestep if t < len(ep)]
-                                 for ep in self.states])
+            x0 = [[ep[t] for t in timestep if t < len(ep)]
+                  for ep in self.states]
+        counts = [len(ep) for ep in x0]
+        x0 = np.concatenate(x0)
 
         # sample indices
-        idx = np.random.choice(range(len(x0)), n_samples)
-        return torch.tensor(x0)[idx].double()
+        if prioritized:
+            # split each episode's priority among its states, so that
+            # episodes are drawn by priority regardless of their length
+            counts = np.asarray(counts)
+            p = np.repeat(
+                np.asarray(self.get_priorities()) / np.maximum(counts, 1),
+                counts)
+            idx = np.random.choice(len(x0), n_samples, p=p / p.sum())
+        else:
+            idx = np.random.choice(range(len(x0)), n_samples)
+        x0 = torch.tensor(x0)[idx].double()
+        # pinned memory allows for asynchronous copies to the gpu
+        return x0.pin_memory() if pin_memory else x0
 
     def save(self, filename):
         try:
@@ -259,12 +334,15 @@ class ExperienceDataset(torch.nn.Module):
                           info=self.info,
                           times_stamps=self.time_stamps,
                           curr_episode=self.curr_episode,
-                          policy_parameters=self.policy_parameters)
+                          policy_parameters=self.policy_parameters,
+                          priorities=self.get_priorities().tolist())
         torch.save(state_dict, filename)
 
     def load(self, filename):
         state_dict = torch.load(filename)
         self.__dict__.update(state_dict)
+        self.priorities = self.get_priorities().tolist()
+        self.dataset_cache = {}
 
 
 class SumTree:
@@ -1,53 +1,178 @@
+import contextlib
 import torch
 
 jit_scripts = {}
 
+if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'cholesky'):
+    cholesky = torch.linalg.cholesky
+else:
+    cholesky = torch.cholesky
+
 
 def mm_resample_infer_ns_(samples, z, jitter):
     M = samples.shape[0]
     m = samples.mean(0)
     deltas = samples - m
-    S = deltas.t().mm(deltas) / (M - 1) + jitter
-    L = S.cholesky()
+    S = torch.addmm(jitter, deltas.t(), deltas, alpha=1.0 / (M - 1))
+    L = cholesky(S)
     z = torch.mm(deltas, L.t().inverse()).detach()
     z = z.detach()
-    return m + z.mm(L.t())
+    return torch.addmm(m, z, L.t())
 
 
 def mm_resample_(samples, z, jitter):
     M = samples.shape[0]
     m = samples.mean(0)
     deltas = samples - m
-    S = deltas.t().mm(deltas) / (M - 1) + jitter
-    L = S.cholesky()
+    S = torch.addmm(jitter, deltas.t(), deltas, alpha=1.0 / (M - 1))
+    L = cholesky(S)
     # make sure we don't underestimate the uncertainty
     z = (z - z.mean(0)) / z.std(0)
     z = z.detach()
-    return m + z.mm(L.t())
+    return torch.addmm(m, z, L.t())
+
+
+def mm_resample_groups_infer_ns_(samples, z, jitter):
+    M = samples.shape[1]
+    m = samples.mean(1, keepdim=True)
+    deltas = samples - m
+    S = torch.baddbmm(jitter, deltas.transpose(1, 2), deltas,
+                      alpha=1.0 / (M - 1))
+    L = cholesky(S)
+    z = torch.matmul(deltas, L.transpose(1, 2).inverse()).detach()
+    z = z.detach()
+    return torch.baddbmm(m, z, L.transpose(1, 2))
+
+
+def mm_resample_groups_(samples, z, jitter):
+    M = samples.shape[1]
+    m = samples.mean(1, keepdim=True)
+    deltas = samples - m
+    S = torch.baddbmm(jitter, deltas.transpose(1, 2), deltas,
+                      alpha=1.0 / (M - 1))
+    L = cholesky(S)
+    # make sure we don't underestimate the uncertainty
+    z = (z - z.mean(1, keepdim=True)) / z.std(1, keepdim=True)
+    z = z.detach()
+    return torch.baddbmm(m, z, L.transpose(1, 2))
+
+
+def mm_resample_scalar_infer_ns_(samples, z, jitter):
+    M = samples.shape[-2]
+    m = samples.mean(-2, keepdim=True)
+    deltas = samples - m
+    # the cholesky factor of a 1x1 covariance is the standard deviation
+    L = (deltas.pow(2).sum(-2, keepdim=True) / (M - 1) + jitter).sqrt()
+    z = (deltas / L).detach()
+    return torch.addcmul(m, z, L)
+
+
+def mm_resample_scalar_(samples, z, jitter):
+    M = samples.shape[-2]
+    m = samples.mean(-2, keepdim=True)
+    deltas = samples - m
+    # the cholesky factor of a 1x1 covariance is the standard deviation
+    L = (deltas.pow(2).sum(-2, keepdim=True) / (M - 1) + jitter).sqrt()
+    # make sure we don't underestimate the uncertainty
+    z = (z - z.mean(-2, keepdim=True)) / z.std(-2, keepdim=True)
+    z = z.detach()
+    return torch.addcmul(m, z, L)
 
 
-def get_mm_resample_script(samples, z, jitter, infer_noise_variables):
+def get_mm_resample_script(samples,
+                           z,
+                           jitter,
+                           infer_noise_variables,
+                           groups=False,
+                           compile=False):
+    '''
+        Returns a compiled moment matching function. If groups is True, the
+        function expects samples and z of shape [groups, particles, dims]
+        and moment matches every group independently in one batched call.
+        One dimensional samples (e.g. rewards) are moment matched with
+        elementwise ops only. If compile is True and torch.compile is
+        available, the function is compiled with it (which needs a working
+        inductor backend); otherwise it is traced with torch.jit.trace.
+    '''
     global jit_scripts
     inputs = (samples, z, jitter)
+    scalar = samples.shape[-1] == 1
     key = (str(inp.type()) + '_' + str(inp.device) for inp in inputs)
-    key = '_'.join(key) + str(infer_noise_variables)
+    key = '_'.join(key) + str(infer_noise_variables) + str(groups) + str(
+        scalar) + str(compile)
     if key not in jit_scripts:
-        mm_resample = (mm_resample_infer_ns_
-                       if infer_noise_variables else mm_resample_)
+        if scalar:
+            mm_resample = (mm_resample_scalar_infer_ns_
+                           if infer_noise_variables else mm_resample_scalar_)
+        elif groups:
+            mm_resample = (mm_resample_groups_infer_ns_
+                           if infer_noise_variables else mm_resample_groups_)
+        else:
+            mm_resample = (mm_resample_infer_ns_
+                           if infer_noise_variables else mm_resample_)
 
-        jit_scripts[key] = torch.jit.trace(mm_resample, inputs)
+        if compile and hasattr(torch, 'compile'):
+            # let inductor fuse the elementwise ops around the cholesky
+            # factorization; graph breaks fall back to eager
+            jit_scripts[key] = torch.compile(mm_resample, fullgraph=False)
+        else:
+            jit_scripts[key] = torch.jit.trace(mm_resample, inputs)
     return jit_scripts[key]
 
 
+def autocast(device_type, dtype=None, enabled=True):
+    '''
+        Returns a torch.autocast context for the given device type, or a
+        context that does nothing if this version of pytorch does not
+        support autocast.
+    '''
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type=device_type,
+                              dtype=dtype,
+                              enabled=enabled)
+    return contextlib.nullcontext()
+
+
+def full_precision(x):
+    '''
+        Returns a context manager that disables autocast on the device of x,
+        so that ops which need full precision (e.g. cholesky) can run inside
+        a mixed precision rollout.
+    '''
+    return autocast(x.device.type, enabled=False)
+
+
 def get_z_rnd(z, i, shape, device=None):
     if z is not None:
-        idxs = torch.arange(i, i + shape[0]).to(device).long()
-        idxs %= shape[0]
-        return z[idxs]
+        if z.shape[0] < shape[0]:
+            raise ValueError(
+                "The noise buffer has {} rows, but at least {} (one per "
+                "particle) are needed".format(z.shape[0], shape[0]))
+        # contiguous window over the pre-sampled numbers (a view, no copy)
+        offset = i % (z.shape[0] - shape[0] + 1)
+        return z[offset:offset + shape[0]]
     else:
         return torch.randn(*shape, device=device)
 
 
+def get_trajectory_buffers(out, steps, states, actions, rewards):
+    '''
+        Returns the [states, actions, rewards] buffers in out, (re)allocating
+        them if they are missing or can't hold a trajectory of the given
+        length.
+    '''
+    shapes = [(steps + 1, ) + states.shape, (steps, ) + actions.shape,
+              (steps, ) + rewards.shape]
+    if len(out) == 0 or any(buf.shape[0] < shape[0]
+                            or buf.shape[1:] != shape[1:]
+                            for buf, shape in zip(out, shapes)):
+        out[:] = [
+            x.new_empty(shape)
+            for x, shape in zip((states, actions, rewards), shapes)
+        ]
+    return out
+
+
 def rollout(states,
             dynamics,
             policy,
@@ -65,19 +190,56 @@ def rollout(states,
             breaking_condition=None,
             on_step=None,
             on_pol_eval=None,
+            out=None,
+            compile_mm=False,
             **kwargs):
     '''
         Obtains trajectory distribution (s_0, a_0, r_0, s_1, a_1, r_1,...)
-        by rolling out the policy on the model, from the given set of states
+        by rolling out the policy on the model, from the given set of states.
+        If out is a list, the trajectory is written into preallocated
+        [states, actions, rewards] tensors of shape [timesteps, batch, dims],
+        which are created on the first call and reused on later calls. The
+        returned tensors are views of these buffers, so they are overwritten
+        by the next rollout that uses the same out list. Since on_step and
+        breaking_condition receive the list of steps, out is ignored when
+        either of them is given. If compile_mm is True, the moment matching
+        functions are compiled with torch.compile.
     '''
+    if callable(on_step) or callable(breaking_condition):
+        out = None
     trajectory = []
-    jitter1, jitter2 = None, None
+    H = 0
+    if out is not None:
+        # drop the autograd history left over from the previous rollout
+        [buf.detach_() for buf in out]
+    # cholesky jitter for the state and reward covariances
+    D = states.shape[-1]
+    jitter1 = 1e-12 * torch.eye(D, device=states.device, dtype=states.dtype)
+    jitter2 = 1e-12 * torch.eye(1, device=states.device, dtype=states.dtype)
 
     # mm_resample = (mm_resample_infer_ns_
     #               if infer_noise_variables else mm_resample_)
-    mm_resample = get_mm_resample_script(states, torch.randn_like(states),
-                                         torch.eye(states.shape[-1]),
-                                         infer_noise_variables)
+    with full_precision(states):
+        mm_resample = get_mm_resample_script(states,
+                                             torch.randn_like(states),
+                                             jitter1, infer_noise_variables,
+                                             compile=compile_mm)
+        mm_resample_r = get_mm_resample_script(states[:, :1],
+                                               torch.randn_like(states[:, :1]),
+                                               jitter2, infer_noise_variables,
+                                               compile=compile_mm)
+        # when the particles split evenly, all groups are moment matched in
+        # a single batched call instead of a python loop over chunks
+        grouped = mm_groups is not None and states.shape[0] % mm_groups == 0
+        if grouped:
+            grouped_states = states.reshape(mm_groups, -1, D)
+            mm_resample_groups = get_mm_resample_script(
+                grouped_states, torch.randn_like(grouped_states), jitter1,
+                infer_noise_variables, True, compile=compile_mm)
+            mm_resample_groups_r = get_mm_resample_script(
+                grouped_states[..., :1],
+                torch.randn_like(grouped_states[..., :1]), jitter2,
+                infer_noise_variables, True, compile=compile_mm)
 
     for i in range(steps):
         try:
@@ -102,33 +264,53 @@ def rollout(states,
                             resample_noise=resample_state_noise)
             next_states, rewards = outs
 
-            # moment matching for states
-            if mm_states:
-                if jitter1 is None:
-                    jitter1 = 1e-12 * torch.eye(states.shape[-1],
-                                                device=states.device)
-                if mm_groups is not None:
-                    next_states = torch.cat([
-                        mm_resample(nsi, z1i, jitter1) for nsi, z1i in zip(
-                            next_states.chunk(mm_groups), z1.chunk(mm_groups))
-                    ])
-                else:
-                    next_states = mm_resample(next_states, z1, jitter1)
-
-            # moment matching for rewards
-            if mm_rewards:
-                if jitter2 is None:
-                    jitter2 = 1e-12 * torch.eye(rewards.shape[-1],
-                                                device=rewards.device)
-                if mm_groups is not None:
-                    rewards = torch.cat([
-                        mm_resample(ri, z2i, jitter2) for ri, z2i in zip(
-                            rewards.chunk(mm_groups), z2.chunk(mm_groups))
-                    ])
-                else:
-                    rewards = mm_resample(rewards, z2, jitter2)
-
-            trajectory.append((states, actions, rewards))
+            # moment matching runs in full precision, even when the
+            # rollout is done under autocast
+            with full_precision(next_states):
+                # moment matching for states
+                if mm_states:
+                    next_states = next_states.to(jitter1.dtype)
+                    if grouped:
+                        next_states = mm_resample_groups(
+                            next_states.reshape(mm_groups, -1, D),
+                            z1.reshape(mm_groups, -1, D),
+                            jitter1).reshape(-1, D)
+                    elif mm_groups is not None:
+                        next_states = torch.cat([
+                            mm_resample(nsi, z1i, jitter1)
+                            for nsi, z1i in zip(next_states.chunk(mm_groups),
+                                                z1.chunk(mm_groups))
+                        ])
+                    else:
+                        next_states = mm_resample(next_states, z1, jitter1)
+
+                # moment matching for rewards
+                if mm_rewards:
+                    rewards = rewards.to(jitter2.dtype)
+                    if grouped:
+                        rewards = mm_resample_groups_r(
+                            rewards.reshape(mm_groups, -1, 1),
+                            z2.reshape(mm_groups, -1, 1),
+                            jitter2).reshape(rewards.shape)
+                    elif mm_groups is not None:
+                        rewards = torch.cat([
+                            mm_resample_r(ri, z2i, jitter2)
+                            for ri, z2i in zip(rewards.chunk(mm_groups),
+                                               z2.chunk(mm_groups))
+                        ])
+                    else:
+                        rewards = mm_resample_r(rewards, z2, jitter2)
+
+            if out is not None:
+                if i == 0:
+                    get_trajectory_buffers(out, steps, states, actions,
+                                           rewards)
+                out[0][i].copy_(states)
+                out[1][i].copy_(actions)
+                out[2][i].copy_(rewards)
+            else:
+                trajectory.append((states, actions, rewards))
+            H += 1
             states = next_states
             if callable(breaking_condition):
                 if breaking_condition(trajectory):
@@ -136,9 +318,14 @@ def rollout(states,
             if callable(on_step):
                 on_step(trajectory)
         except RuntimeError as e:
-            if len(trajectory) > 5:
+            if H > 5:
                 break
             raise e
+    if out is not None:
+        # append last state
+        out[0][H].copy_(next_states)
+        return [out[0][:H + 1], out[1][:H], out[2][:H]]
+
     trajectory = [list(x) for x in zip(*trajectory)]
 
     # append last state
@@ -55,6 +55,50 @@ def custom_pbar(iterable, total):
             break
 
 
+def episode_errors(model, exp, n_samples=10, seed=0, **kwargs):
+    '''
+        Returns the mean absolute error of the model predictions, relative
+        to the output scale of the model, for every episode in exp. The
+        predictions are averaged over n_samples dropout samples, drawn with
+        the same seed for every episode, so that all episodes are scored
+        with the same model samples. The sampled noise buffers of the model
+        are restored afterwards. Episodes that are too short to be scored
+        get the largest error, so that they keep a high priority. kwargs
+        are passed to exp.get_dynmodel_dataset and should match the ones used
+        to build the training dataset of the model.
+    '''
+    # the forward passes below may overwrite the stored dropout masks and
+    # output noise; keep copies so we can put them back
+    saved_buffers = [(m, name, buf.clone()) for m in model.modules()
+                     if m is not model for name, buf in m._buffers.items()
+                     if buf is not None]
+    devices = [model.X.device] if model.X.is_cuda else []
+    errors = []
+    with torch.no_grad():
+        for epi in range(exp.n_episodes()):
+            if len(exp.states[epi]) < 2:
+                errors.append(np.nan)
+                continue
+            X, Y = exp.get_dynmodel_dataset(filter_episodes=[epi], **kwargs)
+            X = X.to(model.X.device, model.X.dtype)
+            Y = Y.to(model.X.device, model.X.dtype)
+            M = 0
+            with torch.random.fork_rng(devices=devices):
+                torch.manual_seed(seed)
+                for j in range(n_samples):
+                    outs = model(X, resample=True)
+                    M = M + (outs[0] if isinstance(outs, tuple) else outs)
+            M = M / n_samples
+            errors.append(((M - Y) * model.iSy).abs().mean().item())
+    for m, name, buf in saved_buffers:
+        m._buffers[name] = buf
+
+    errors = np.array(errors)
+    scored = ~np.isnan(errors)
+    errors[~scored] = errors[scored].max() if scored.any() else 1.0
+    return errors
+
+
 def train_regressor(model,
                     iters=2000,
                     batchsize=100,